@@ -11,11 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy
 import logging
 import os
+import threading
 from dataclasses import asdict, dataclass, field
 from enum import Enum
+from functools import partial
 from typing import Dict, Optional, Tuple
 
 import flax
@@ -27,7 +28,7 @@ import tensorflow as tf
 import wandb
 from flax import jax_utils, traverse_util
 from flax.training import train_state
-from flax.training.common_utils import onehot, shard
+from flax.training.common_utils import shard
 from transformers import (
     AutoTokenizer,
     HfArgumentParser,
@@ -96,6 +97,15 @@ class TrainingArguments:
     save_steps: int = field(
         default=10000, metadata={"help": "Save checkpoint every X updates steps."}
     )
+    embedding_quantization_steps: int = field(
+        default=0,
+        metadata={
+            "help": (
+                "If > 0, the discriminator reads an int8 copy of the generator word embeddings that is refreshed"
+                " every X updates steps. Not compatible with --tie_embeddings."
+            )
+        },
+    )
     seed: int = field(
         default=42,
         metadata={"help": "Random seed that will be set at the beginning of training."},
@@ -174,7 +184,7 @@ class ModelArguments:
         },
     )
     dtype: Optional[str] = field(
-        default="float32",
+        default="bfloat16",
         metadata={
             "help": (
                 "Floating-point format in which the model weights should be initialized and trained. Choose one of"
@@ -182,6 +192,15 @@ class ModelArguments:
             )
         },
     )
+    tie_embeddings: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether the discriminator should look up its inputs in the generator word embeddings (trained by"
+                " both losses) instead of averaging its own word embeddings with the generator ones."
+            )
+        },
+    )
 
 
 @dataclass
@@ -202,12 +221,15 @@ class DataTrainingArguments:
     )
 
 
-@flax.struct.dataclass
+@dataclass
 class FlaxDataCollatorForMaskedLM:
     tokenizer: PreTrainedTokenizerBase
     mlm_probability: float = 0.15
     replace_prob = 0.1
     orginal_prob = 0.1
+    special_ids: np.ndarray = field(init=False)
+    mask_token_id: int = field(init=False)
+    vocab_size: int = field(init=False)
 
     def __post_init__(self):
         if self.tokenizer.mask_token is None:
@@ -216,63 +238,75 @@ class FlaxDataCollatorForMaskedLM:
                 "You should pass `mlm=False` to train on causal language modeling instead."
             )
 
-    def __call__(self, input_ids: np.ndarray) -> Dict[str, np.ndarray]:
-        # Handle dict or lists with proper padding and conversion to tensor.
-        batch = {"input_ids": input_ids, "attention_mask": np.ones_like(input_ids), "original_ids": input_ids}
+        # the tokenizer never changes during training, look these up once
+        self.special_ids = np.asarray(self.tokenizer.all_special_ids, dtype=np.int32)
+        self.mask_token_id = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
+        self.vocab_size = self.tokenizer.vocab_size
+
+    def __call__(self, input_ids: jnp.ndarray, rng: jax.random.PRNGKey) -> Dict[str, jnp.ndarray]:
+        # Called inside the pmapped train step, so masking runs on device.
+        batch = {"input_ids": input_ids, "original_ids": input_ids}
 
         special_tokens_mask = self.get_special_tokens_mask(input_ids)
 
-        batch["input_ids"], batch["labels"], batch["masked_indices"] = self.mask_tokens(
-            batch["input_ids"], special_tokens_mask=special_tokens_mask
+        batch["input_ids"], batch["labels"], batch["masked_indices"] = mask_tokens(
+            rng,
+            batch["input_ids"],
+            special_tokens_mask,
+            mlm_probability=self.mlm_probability,
+            mask_token_id=self.mask_token_id,
+            vocab_size=self.vocab_size,
         )
         return batch
 
     # get special tokens mask
-    def get_special_tokens_mask(self, input_ids: np.ndarray) -> np.ndarray:
-        special_tokens_mask = np.zeros_like(input_ids, dtype=np.bool_)
+    def get_special_tokens_mask(self, input_ids: jnp.ndarray) -> jnp.ndarray:
+        return (input_ids[..., None] == self.special_ids).any(-1)
+
+
+@partial(jax.jit, static_argnames=("mlm_probability", "mask_token_id", "vocab_size"))
+def mask_tokens(
+        rng: jax.random.PRNGKey,
+        inputs: jnp.ndarray,
+        special_tokens_mask: jnp.ndarray,
+        mlm_probability: float,
+        mask_token_id: int,
+        vocab_size: int,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """
+    Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
+    """
+    masked_rng, replaced_rng, random_rng, random_words_rng = jax.random.split(rng, 4)
 
-        for special_token in self.tokenizer.all_special_ids:
-            special_tokens_mask |= input_ids == special_token
+    # We sample a few tokens in each sequence for MLM training (with probability `mlm_probability`)
+    masked_indices = jax.random.bernoulli(masked_rng, mlm_probability, inputs.shape)
+    masked_indices &= ~special_tokens_mask.astype("bool")
+    labels = jnp.where(masked_indices, inputs, -100)  # We only compute loss on masked tokens
 
-        return special_tokens_mask
+    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
+    indices_replaced = jax.random.bernoulli(replaced_rng, 0.8, inputs.shape) & masked_indices
+    inputs = jnp.where(indices_replaced, mask_token_id, inputs)
 
-    def mask_tokens(
-            self, inputs: np.ndarray, special_tokens_mask: Optional[np.ndarray]
-    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-        """
-        Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
-        """
-        labels = inputs.copy()
-        # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
-        probability_matrix = np.full(labels.shape, self.mlm_probability)
-        special_tokens_mask = special_tokens_mask.astype("bool")
-
-        probability_matrix[special_tokens_mask] = 0.0
-        masked_indices = np.random.binomial(1, probability_matrix).astype("bool")
-        labels[~masked_indices] = -100  # We only compute loss on masked tokens
-
-        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = (
-                np.random.binomial(1, np.full(labels.shape, 0.8)).astype("bool")
-                & masked_indices
-        )
-        inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(
-            self.tokenizer.mask_token
-        )
+    # 10% of the time, we replace masked input tokens with random word
+    indices_random = jax.random.bernoulli(random_rng, 0.5, inputs.shape)
+    indices_random &= masked_indices & ~indices_replaced
 
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = np.random.binomial(1, np.full(labels.shape, 0.5)).astype(
-            "bool"
-        )
-        indices_random &= masked_indices & ~indices_replaced
+    random_words = jax.random.randint(
+        random_words_rng, inputs.shape, 0, vocab_size, dtype=inputs.dtype
+    )
+    inputs = jnp.where(indices_random, random_words, inputs)
+
+    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+    return inputs, labels, masked_indices
 
-        random_words = np.random.randint(
-            self.tokenizer.vocab_size, size=labels.shape, dtype="i4"
-        )
-        inputs[indices_random] = random_words[indices_random]
 
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-        return inputs, labels, masked_indices
+def quantize_embedding(embedding: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """
+    Quantize an embedding table to int8 with a symmetric per-row scale.
+    """
+    scale = jnp.abs(embedding).max(axis=-1, keepdims=True) / 127.0
+    scale = jnp.where(scale == 0, 1.0, scale)
+    return jnp.round(embedding / scale).astype(jnp.int8), scale
 
 
 def main():
@@ -375,6 +409,20 @@ def main():
             dtype=getattr(jnp, model_args.dtype),
         )
 
+    if model_args.tie_embeddings and (
+            generator_config.vocab_size != discriminator_config.vocab_size
+            or generator_config.hidden_size != discriminator_config.hidden_size
+    ):
+        raise ValueError(
+            "--tie_embeddings requires the generator and the discriminator to have the same vocab_size and hidden_size"
+        )
+
+    if model_args.tie_embeddings and training_args.embedding_quantization_steps > 0:
+        raise ValueError(
+            "--embedding_quantization_steps can't be used with --tie_embeddings, the shared embeddings are trained"
+            " by the discriminator"
+        )
+
     # Store some constant
     train_batch_size = int(training_args.train_batch_size)
     num_train_steps = int(training_args.num_train_steps)
@@ -383,13 +431,24 @@ def main():
     def _parse_function(example_proto):
         features = {"text": tf.io.FixedLenFeature([512], tf.int64)}
         parsed_features = tf.io.parse_single_example(example_proto, features)
-        return parsed_features["text"]
-
-    data_files = tf.io.gfile.glob(data_args.dataset_name)
-    dataset = tf.data.TFRecordDataset(data_files, compression_type=data_args.compression_type)
+        # tf.io only parses int64, narrow the ids right away so shuffling, batching and transfers move half the bytes
+        return tf.cast(parsed_features["text"], tf.int32)
+
+    data_files = tf.data.Dataset.list_files(data_args.dataset_name, shuffle=True)
+    # repeat after the interleave so every record is read once per epoch, even with fewer than 16 files
+    dataset = data_files.interleave(
+        lambda f: tf.data.TFRecordDataset(f, compression_type=data_args.compression_type),
+        cycle_length=16,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=False,
+    ).repeat()
     dataset = dataset.map(_parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    dataset = dataset.shuffle(65536)
-    dataset = dataset.batch(train_batch_size, drop_remainder=True)
+    # files are already shuffled and interleaved, a small example-level buffer is enough on top of that as long as
+    # the dataset is split into at least 16 shards, with fewer shards consecutive examples come from the same file
+    dataset = dataset.shuffle(4096)
+    dataset = dataset.batch(
+        train_batch_size * training_args.gradient_accumulation_steps, drop_remainder=True
+    )
     dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
     # Create learning rate schedule
@@ -425,145 +484,225 @@ def main():
         }
         return traverse_util.unflatten_dict(flat_mask)
 
-    if training_args.adamw:
-        optimizer = optax.adamw(
-            learning_rate=linear_decay_lr_schedule_fn,
-            b1=training_args.adam_beta1,
-            b2=training_args.adam_beta2,
-            eps=training_args.adam_epsilon,
-            weight_decay=training_args.weight_decay,
-            mask=decay_mask_fn,
-        )
-    else:
-        optimizer = optax.lamb(
-            learning_rate=linear_decay_lr_schedule_fn,
-            b1=training_args.adam_beta1,
-            b2=training_args.adam_beta2,
-            eps=training_args.adam_epsilon,
-            weight_decay=training_args.weight_decay,
-            mask=decay_mask_fn,
-        )
-
-    optimizer = optax.chain(
-        optax.clip_by_global_norm(training_args.max_grad_norm),
-        optimizer,
-    )
+    def create_optimizer(params):
+        # materialize the weight decay mask once instead of rebuilding it on every optimizer call
+        decay_mask = decay_mask_fn(params)
+
+        if training_args.adamw:
+            optimizer = optax.adamw(
+                learning_rate=linear_decay_lr_schedule_fn,
+                b1=training_args.adam_beta1,
+                b2=training_args.adam_beta2,
+                eps=training_args.adam_epsilon,
+                weight_decay=training_args.weight_decay,
+                mask=decay_mask,
+            )
+        else:
+            optimizer = optax.lamb(
+                learning_rate=linear_decay_lr_schedule_fn,
+                b1=training_args.adam_beta1,
+                b2=training_args.adam_beta2,
+                eps=training_args.adam_epsilon,
+                weight_decay=training_args.weight_decay,
+                mask=decay_mask,
+            )
 
-    if training_args.gradient_accumulation_steps > 1:
-        optimizer = optax.MultiSteps(
-            optimizer, training_args.gradient_accumulation_steps
+        return optax.chain(
+            optax.clip_by_global_norm(training_args.max_grad_norm),
+            optimizer,
         )
 
-    # copy optimizer for generator and discriminator
-    generator_optimizer = copy.deepcopy(optimizer)
-    discriminator_optimizer = copy.deepcopy(optimizer)
+    discriminator_params = discriminator.params
+    if model_args.tie_embeddings:
+        # the discriminator only reads the generator word embeddings, so don't keep and optimize its own table
+        discriminator_params = flax.core.unfreeze(discriminator_params)
+        del discriminator_params["roberta"]["embeddings"]["word_embeddings"]
 
     generator_state = train_state.TrainState.create(
-        apply_fn=generator.__call__, params=generator.params, tx=generator_optimizer
+        apply_fn=generator.__call__,
+        params=generator.params,
+        tx=create_optimizer(generator.params),
     )
     discriminator_state = train_state.TrainState.create(
         apply_fn=discriminator.__call__,
-        params=discriminator.params,
-        tx=discriminator_optimizer,
+        params=discriminator_params,
+        tx=create_optimizer(discriminator_params),
     )
 
-    def train_step(state_g, state_d, batch, dropout_rng):
-        dropout_rng, new_dropout_rng, sample_rng = jax.random.split(dropout_rng, 3)
+    dtype = getattr(jnp, model_args.dtype)
+
+    def cast_params(params):
+        # keep the float32 master weights in the train state and only run the forward/backward in `dtype`
+        return jax.tree_util.tree_map(
+            lambda x: x.astype(dtype) if x.dtype == jnp.float32 else x, params
+        )
+
+    def train_step(state_g, state_d, input_ids, dropout_rng, quantized_embedding=None):
+        generator_embedding = state_g.params["roberta"]["embeddings"]["word_embeddings"]["embedding"]
 
-        def generator_loss_fn(params):
+        def generator_loss_fn(params, batch, dropout_rng, sample_rng):
             labels = batch["labels"]
 
+            # sequences are fixed-length without padding, the models default to an all-ones attention mask
             logits = state_g.apply_fn(
                 batch["input_ids"],
-                batch["attention_mask"],
-                params=params,
+                params=cast_params(params),
                 dropout_rng=dropout_rng,
                 train=True,
             )[0]
 
-            label_mask = jnp.where(labels > 0, 1.0, 0.0)
+            logits = logits.astype(jnp.float32)
+
+            # sample the replaced tokens with the gumbel-max trick, in float32 since bfloat16 noise is too coarse
+            # and makes argmax ties (resolved towards low token ids) common over the vocabulary
+            gumbel = jax.random.gumbel(sample_rng, logits.shape, dtype=jnp.float32)
+            pred_ids = jnp.argmax(jax.lax.stop_gradient(logits) + gumbel, axis=-1)
+
+            label_mask = labels >= 0
             loss = (
-                    optax.softmax_cross_entropy(logits, onehot(labels, logits.shape[-1]))
+                    optax.softmax_cross_entropy_with_integer_labels(
+                        logits, jnp.where(label_mask, labels, 0)
+                    )
                     * label_mask
             )
 
             loss = loss.sum()
             num_labels = label_mask.sum()
 
-            return loss, (logits, num_labels)
+            return loss, (pred_ids, num_labels)
 
-        def discriminator_loss_fn(params):
+        def discriminator_loss_fn(params, generator_embedding, batch, dropout_rng):
             input_ids = batch["pred_ids"]
             labels = batch["replaced_ids"].astype("float32")
-
-            input_embeds = jnp.take(
-                params["roberta"]["embeddings"]["word_embeddings"]["embedding"],
-                input_ids,
-                axis=0,
-            ) + jnp.take(
-                state_g.params["roberta"]["embeddings"]["word_embeddings"]["embedding"],
-                input_ids,
-                axis=0,
-            )
-            input_embeds = input_embeds / 2
-
+            params = cast_params(params)
+
+            if quantized_embedding is not None:
+                # the generator embeddings are read-only here, so gather from the int8 copy and dequantize
+                int8_embedding, scale = quantized_embedding
+                generator_embeds = (
+                        jnp.take(int8_embedding, input_ids, axis=0).astype(dtype)
+                        * jnp.take(scale, input_ids, axis=0).astype(dtype)
+                )
+            else:
+                generator_embeds = jnp.take(generator_embedding, input_ids, axis=0).astype(dtype)
+            if model_args.tie_embeddings:
+                input_embeds = generator_embeds
+            else:
+                input_embeds = jnp.take(
+                    params["roberta"]["embeddings"]["word_embeddings"]["embedding"],
+                    input_ids,
+                    axis=0,
+                ) + generator_embeds
+                input_embeds = input_embeds / 2
+
+            # the embeddings module skips its own word embedding lookup when `inputs_embeds` is given,
+            # `input_ids` is only used to build the position and token type ids
             logits = state_d.apply_fn(
                 input_ids=input_ids,
-                attention_mask=batch["attention_mask"],
                 inputs_embeds=input_embeds,
                 params=params,
                 dropout_rng=dropout_rng,
                 train=True,
             )[0]
+            logits = logits.astype(jnp.float32)
 
-            label_mask = jnp.ones_like(labels)
             loss = optax.sigmoid_binary_cross_entropy(logits, labels)
 
             loss = loss.sum() * 50
-            num_labels = label_mask.sum()
+            num_labels = jnp.array(labels.size, jnp.float32)
 
             return loss, (logits, num_labels)
 
         generator_grad_fn = jax.value_and_grad(generator_loss_fn, has_aux=True)
-        (generator_loss, (logits, num_labels)), generator_grad = generator_grad_fn(
-            state_g.params
+        # with tied embeddings the discriminator loss also trains the generator word embeddings,
+        # differentiate with respect to that single table rather than the whole generator
+        discriminator_grad_fn = jax.value_and_grad(
+            discriminator_loss_fn,
+            argnums=(0, 1) if model_args.tie_embeddings else 0,
+            has_aux=True,
         )
-        num_labels_g = jax.lax.psum(num_labels, "batch")
 
-        generator_loss = jax.lax.psum(generator_loss, "batch")
-        generator_loss = jax.tree_util.tree_map(
-            lambda x: x / num_labels_g, generator_loss
+        def accumulate_step(carry, input_ids):
+            accumulated, dropout_rng = carry
+            dropout_rng, new_dropout_rng, sample_rng, mask_rng = jax.random.split(dropout_rng, 4)
+            batch = data_collator(input_ids, mask_rng)
+
+            (generator_loss, (pred_ids, num_labels_g)), generator_grad = generator_grad_fn(
+                state_g.params, batch, dropout_rng, sample_rng
+            )
+
+            pred_ids = jnp.where(batch["masked_indices"], pred_ids, batch["input_ids"])
+
+            batch["pred_ids"] = pred_ids
+            batch["replaced_ids"] = (pred_ids != batch["original_ids"])
+
+            (
+                discriminator_loss,
+                (_, num_labels_d),
+            ), discriminator_grad = discriminator_grad_fn(
+                state_d.params, generator_embedding, batch, dropout_rng
+            )
+
+            accumulated = jax.tree_util.tree_map(
+                jnp.add,
+                accumulated,
+                {
+                    "generator_loss": generator_loss,
+                    "generator_grad": generator_grad,
+                    "num_labels_g": num_labels_g,
+                    "discriminator_loss": discriminator_loss,
+                    "discriminator_grad": discriminator_grad,
+                    "num_labels_d": num_labels_d,
+                },
+            )
+            return (accumulated, new_dropout_rng), None
+
+        # accumulate the gradients of every minibatch in-graph and apply them once
+        input_ids = input_ids.reshape(
+            (training_args.gradient_accumulation_steps, -1) + input_ids.shape[1:]
+        )
+        discriminator_grad = jax.tree_util.tree_map(jnp.zeros_like, state_d.params)
+        if model_args.tie_embeddings:
+            discriminator_grad = (discriminator_grad, jnp.zeros_like(generator_embedding))
+        accumulated = {
+            "generator_loss": jnp.zeros((), jnp.float32),
+            "generator_grad": jax.tree_util.tree_map(jnp.zeros_like, state_g.params),
+            "num_labels_g": jnp.zeros((), jnp.float32),
+            "discriminator_loss": jnp.zeros((), jnp.float32),
+            "discriminator_grad": discriminator_grad,
+            "num_labels_d": jnp.zeros((), jnp.float32),
+        }
+        (accumulated, new_dropout_rng), _ = jax.lax.scan(
+            accumulate_step, (accumulated, dropout_rng), input_ids
         )
 
-        generator_grad = jax.lax.psum(generator_grad, "batch")
+        num_labels_g = jax.lax.psum(accumulated["num_labels_g"], "batch")
+
+        generator_loss = jax.lax.psum(accumulated["generator_loss"], "batch")
+        generator_loss = generator_loss / num_labels_g
+
+        generator_grad = jax.lax.psum(accumulated["generator_grad"], "batch")
         generator_grad = jax.tree_util.tree_map(
             lambda x: x / num_labels_g, generator_grad
         )
-        new_state_g = state_g.apply_gradients(grads=generator_grad)
 
-        gumbel = jax.random.gumbel(rng, logits.shape)
-        pred_ids = jnp.argmax(logits + gumbel, axis=-1)
-        pred_ids = jnp.where(batch["masked_indices"], pred_ids, batch["input_ids"])
+        num_labels_d = jax.lax.psum(accumulated["num_labels_d"], "batch")
 
-        batch["pred_ids"] = pred_ids
-        batch["replaced_ids"] = (pred_ids != batch["original_ids"])
-
-        discriminator_grad_fn = jax.value_and_grad(discriminator_loss_fn, has_aux=True)
-        (
-            discriminator_loss,
-            (logits, num_labels),
-        ), discriminator_grad = discriminator_grad_fn(state_d.params)
-        num_labels_d = jax.lax.psum(num_labels, "batch")
-
-        discriminator_loss = jax.lax.psum(discriminator_loss, "batch")
-        discriminator_loss = jax.tree_util.tree_map(
-            lambda x: x / num_labels_d, discriminator_loss
-        )
+        discriminator_loss = jax.lax.psum(accumulated["discriminator_loss"], "batch")
+        discriminator_loss = discriminator_loss / num_labels_d
 
-        discriminator_grad = jax.lax.psum(discriminator_grad, "batch")
+        discriminator_grad = jax.lax.psum(accumulated["discriminator_grad"], "batch")
         discriminator_grad = jax.tree_util.tree_map(
             lambda x: x / num_labels_d, discriminator_grad
         )
+        if model_args.tie_embeddings:
+            discriminator_grad, tied_embedding_grad = discriminator_grad
+            embedding_path = ("roberta", "embeddings", "word_embeddings", "embedding")
+            flat_generator_grad = traverse_util.flatten_dict(generator_grad)
+            flat_generator_grad[embedding_path] = flat_generator_grad[embedding_path] + tied_embedding_grad
+            generator_grad = traverse_util.unflatten_dict(flat_generator_grad)
+
+        new_state_g = state_g.apply_gradients(grads=generator_grad)
         new_state_d = state_d.apply_gradients(
             grads=discriminator_grad
         )
@@ -577,69 +716,119 @@ def main():
         return new_state_g, new_state_d, metrics, new_dropout_rng
 
     p_train_step = jax.pmap(train_step, axis_name="batch", donate_argnums=(0, 1,))
+    p_quantize_embedding = jax.pmap(
+        lambda params: quantize_embedding(
+            params["roberta"]["embeddings"]["word_embeddings"]["embedding"]
+        )
+    )
+    quantized_embedding = None
 
     generator_state = jax_utils.replicate(generator_state)
     discriminator_state = jax_utils.replicate(discriminator_state)
 
+    def log_metrics(step, train_metric):
+        train_metric = jax_utils.unreplicate(train_metric)
+        wandb.log(
+            {
+                "loss": float(train_metric["loss"]),
+                "generator_loss": float(train_metric["generator_loss"]),
+                "discriminator_loss": float(train_metric["discriminator_loss"]),
+                "learning_rate": float(linear_decay_lr_schedule_fn(step)),
+            },
+            step=step,
+        )
+
+    save_errors = []
+
+    def save_checkpoint(outdir, generator_params, discriminator_params):
+        try:
+            generator.save_pretrained(
+                f"{outdir}/generator", params=generator_params
+            )
+            discriminator.save_pretrained(
+                f"{outdir}/discriminator", params=discriminator_params
+            )
+
+            tokenizer.save_pretrained(outdir)
+        except Exception as e:
+            # exceptions don't propagate out of a thread, hand it over to the training loop
+            save_errors.append((outdir, e))
+
+    def join_save_thread():
+        save_thread.join()
+        if save_errors:
+            outdir, error = save_errors.pop()
+            logger.error(f"Saving checkpoint to {outdir} failed")
+            raise error
+
     print("***** Running training *****")
     cur_step = 0
-    minibatch_idx = 0
-    while cur_step < num_train_steps:
-        for batch in dataset:
-            batch = data_collator(batch.numpy())
-            batch = shard(batch)
+    pending_metric = None
+    save_thread = None
+    # copy the next batches to the devices while the current step is running
+    train_loader = jax_utils.prefetch_to_device(map(shard, dataset.as_numpy_iterator()), 2)
+    for batch in train_loader:
+        if cur_step >= num_train_steps:
+            break
+
+        if (
+                training_args.embedding_quantization_steps > 0
+                and cur_step % training_args.embedding_quantization_steps == 0
+        ):
+            quantized_embedding = p_quantize_embedding(generator_state.params)
 
-            (
-                generator_state,
-                discriminator_state,
-                train_metric,
-                dropout_rngs,
-            ) = p_train_step(generator_state, discriminator_state, batch, dropout_rngs)
-
-            minibatch_idx += 1
-            if minibatch_idx != training_args.gradient_accumulation_steps:
-                continue
-            minibatch_idx = 0
-
-            cur_step += 1
-            if cur_step % training_args.logging_steps == 0:
-                train_metric = jax_utils.unreplicate(train_metric)
-                wandb.log(
-                    {
-                        "loss": float(train_metric["loss"]),
-                        "generator_loss": float(train_metric["generator_loss"]),
-                        "discriminator_loss": float(train_metric["discriminator_loss"]),
-                        "learning_rate": float(linear_decay_lr_schedule_fn(cur_step)),
-                    },
-                    step=cur_step,
-                )
+        (
+            generator_state,
+            discriminator_state,
+            train_metric,
+            dropout_rngs,
+        ) = p_train_step(
+            generator_state, discriminator_state, batch, dropout_rngs, quantized_embedding
+        )
 
-            if cur_step % training_args.save_steps == 0:
-                if jax.process_index() == 0:
-                    outdir = os.path.join(
-                        training_args.output_dir, f"checkpoint-{cur_step}"
-                    )
+        cur_step += 1
+        if cur_step % training_args.logging_steps == 0:
+            # log the metrics of the previous logging step, which have long been computed, so fetching
+            # them does not block on the step that was just dispatched
+            if pending_metric is not None:
+                log_metrics(*pending_metric)
+            pending_metric = (cur_step, train_metric)
+
+        if cur_step % training_args.save_steps == 0:
+            if jax.process_index() == 0:
+                outdir = os.path.join(
+                    training_args.output_dir, f"checkpoint-{cur_step}"
+                )
 
-                    generator_params = jax.device_get(
-                        jax.tree_util.tree_map(lambda x: x[0], generator_state.params)
+                generator_params = jax.device_get(
+                    jax.tree_util.tree_map(lambda x: x[0], generator_state.params)
+                )
+                discriminator_params = jax.device_get(
+                    jax.tree_util.tree_map(
+                        lambda x: x[0], discriminator_state.params
                     )
-                    discriminator_params = jax.device_get(
-                        jax.tree_util.tree_map(
-                            lambda x: x[0], discriminator_state.params
-                        )
+                )
+                if model_args.tie_embeddings:
+                    # the discriminator trains without its own word embeddings, save the shared ones with it
+                    discriminator_params = flax.core.unfreeze(discriminator_params)
+                    discriminator_params["roberta"]["embeddings"]["word_embeddings"] = (
+                        generator_params["roberta"]["embeddings"]["word_embeddings"]
                     )
 
-                    generator.save_pretrained(
-                        f"{outdir}/generator", params=generator_params
-                    )
-                    discriminator.save_pretrained(
-                        f"{outdir}/discriminator", params=discriminator_params
-                    )
+                # write the checkpoint in the background so training keeps running during the IO
+                if save_thread is not None:
+                    join_save_thread()
+                save_thread = threading.Thread(
+                    target=save_checkpoint,
+                    args=(outdir, generator_params, discriminator_params),
+                )
+                save_thread.start()
 
-                    tokenizer.save_pretrained(outdir)
+    if pending_metric is not None:
+        log_metrics(*pending_metric)
 
-            if cur_step >= num_train_steps:
-                break
+    if save_thread is not None:
+        join_save_thread()
 
 
 if __name__ == "__main__":